@@ -5,6 +5,10 @@ gpus = [0]
 save_top_k = 3
 save_last = True
 check_val_every_n_epoch = 1
+accumulate_grad_batches = 1
+channels_last = True
+compile = True
+precision = None # None picks bf16-mixed on Ampere+ and 16-mixed otherwise
 logging_interval = 'epoch'
 resume_ckpt_path = None
 monitor = ['val_change_f1',
@@ -52,8 +56,7 @@ loss_config = dict(
             mask_weight=10.0,
             no_object_weight=0.1,
             dec_layers = 14,
-            num_classes=num_class - 1,
-            device="cuda:{}".format(gpus[0])
+            num_classes=num_class - 1
         )
     )
 )
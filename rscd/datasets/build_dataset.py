@@ -1,7 +1,7 @@
-import sys
-sys.path.append('rscd')
+import os
 from typing import Iterable, Optional, Sequence, Union
-from torch.utils.data import DataLoader, Dataset, Sampler
+import torch.distributed as dist
+from torch.utils.data import DataLoader, Dataset, Sampler, DistributedSampler
 from torch.utils.data.dataloader import _collate_fn_t, _worker_init_fn_t
 from rscd.datasets.levircd_dataset import *
 from rscd.datasets.whucd_dataset import *
@@ -35,13 +35,34 @@ def build_dataloader(cfg, mode='train'): # get dataloader
         dataset = eval(dataset_type)(data_root, mode, **cfg.test_mode)
         loader_cfg = cfg.test_mode.loader
 
+    # each rank reads its own shard once the process group is up
+    sampler = None
+    shuffle = loader_cfg.shuffle
+    if dist.is_available() and dist.is_initialized():
+        sampler = DistributedSampler(dataset,
+                                     shuffle = shuffle,
+                                     seed = int(os.getenv('PL_GLOBAL_SEED', 0)),
+                                     drop_last = loader_cfg.drop_last)
+        shuffle = False
+
+    # keep the worker pool alive between epochs and a few batches ahead of the model
+    num_workers = loader_cfg.get('num_workers', min(8, os.cpu_count() or 1))
+    worker_kwargs = dict()
+    if num_workers > 0:
+        worker_kwargs = dict(
+            persistent_workers = loader_cfg.get('persistent_workers', True),
+            prefetch_factor = loader_cfg.get('prefetch_factor', 4)
+        )
+
     data_loader = DataLoader(
         dataset = dataset,
         batch_size = loader_cfg.batch_size,
-        num_workers = loader_cfg.num_workers,
-        pin_memory = loader_cfg.pin_memory,
-        shuffle = loader_cfg.shuffle,
-        drop_last = loader_cfg.drop_last
+        num_workers = num_workers,
+        pin_memory = loader_cfg.get('pin_memory', True),
+        shuffle = shuffle,
+        sampler = sampler,
+        drop_last = loader_cfg.drop_last,
+        **worker_kwargs
     )
     
     return data_loader
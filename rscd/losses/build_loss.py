@@ -2,18 +2,30 @@ import torch
 import torch.nn as nn
 from rscd.losses.loss_func import CELoss, FocalLoss, dice_loss
 
+def _to_float(preds):
+    if isinstance(preds, torch.Tensor):
+        return preds.float() if preds.is_floating_point() else preds
+    if isinstance(preds, dict):
+        return {k: _to_float(v) for k, v in preds.items()}
+    if isinstance(preds, (list, tuple)):
+        return type(preds)(_to_float(v) for v in preds)
+    return preds
+
 class myLoss(nn.Module):
     def __init__(self, param, loss_name=['CELoss'], loss_weight=[1.0], **kwargs):
         super(myLoss, self).__init__()
         self.loss_weight = loss_weight
-        self.loss = list()
+        self.loss = nn.ModuleList()
         for _loss in loss_name:
             self.loss.append(eval(_loss)(**param[_loss],**kwargs))
     
     def forward(self, preds, target):
-        loss = 0
-        for i in range(0, len(self.loss)):
-            loss += self.loss[i](preds, target) * self.loss_weight[i]
+        # softmax / log terms are computed in fp32 even under mixed precision
+        with torch.autocast(device_type='cuda', enabled=False):
+            preds = _to_float(preds)
+            loss = 0
+            for i in range(0, len(self.loss)):
+                loss += self.loss[i](preds, target) * self.loss_weight[i]
         return loss
     
 def build_loss(cfg):
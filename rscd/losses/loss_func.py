@@ -87,7 +87,7 @@ class dice_loss(nn.Module):
             neg_prob = 1 - pos_prob
             probas = torch.cat([pos_prob, neg_prob], dim=1)
         else:
-            p = torch.eye(num_classes).cuda()
+            p = torch.eye(num_classes, device=logits.device)
             true_1_hot = p[true.squeeze(1)]
             true_1_hot = true_1_hot.permute(0, 3, 1, 2).float()
             probas = F.softmax(logits, dim=1)
@@ -8,12 +8,9 @@ import numpy as np
 import torch.nn.functional as F
 import torch.distributed as dist
 from torch import nn
-import sys
-import os
-sys.path.append(os.path.dirname(__file__) + os.sep + '../')
 
-from loss_util.point_features import point_sample, get_uncertain_point_coords_with_randomness
-from loss_util.misc import is_dist_avail_and_initialized, nested_tensor_from_tensor_list, get_world_size
+from rscd.losses.loss_util.point_features import point_sample, get_uncertain_point_coords_with_randomness
+from rscd.losses.loss_util.misc import is_dist_avail_and_initialized, nested_tensor_from_tensor_list, get_world_size
 
 
 def dice_loss(
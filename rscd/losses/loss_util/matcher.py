@@ -9,7 +9,7 @@ from scipy.optimize import linear_sum_assignment
 from torch import nn
 from torch.cuda.amp import autocast
 
-from loss_util.point_features import point_sample
+from rscd.losses.loss_util.point_features import point_sample
 
 import numpy as np
 
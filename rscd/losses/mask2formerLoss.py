@@ -22,10 +22,8 @@ class Mask2formerLoss(nn.Module):
                  mask_weight=5.0,
                  no_object_weight=0.1,
                  dec_layers = 10,
-                 num_classes = 1,
-                 device="cuda:0"):
+                 num_classes = 1):
         super(Mask2formerLoss, self).__init__()
-        self.device = device
         self.class_weight = class_weight
         self.dice_weight = dice_weight
         self.mask_weight = mask_weight
@@ -58,7 +56,7 @@ class Mask2formerLoss(nn.Module):
             num_points=12544,
             oversample_ratio=3.0,
             importance_sample_ratio=0.75,
-            device=torch.device(self.device)
+            device=preds["pred_masks"].device
         )
 
         preds["pred_masks"]= F.interpolate(
@@ -1,7 +1,5 @@
 import torch
 from torch import nn
-import sys
-sys.path.append('rscd')
 from utils.build import build_from_cfg
 
 class myModel(nn.Module):
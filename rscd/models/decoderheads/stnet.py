@@ -5,8 +5,6 @@
 import torch 
 import torch.nn as nn
 import torch.nn.functional as F
-import sys
-sys.path.append('rscd')
 
 def conv_3x3(in_channel, out_channel):
     return nn.Sequential(
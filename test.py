@@ -23,6 +23,7 @@ def get_args():
 
 if __name__ == "__main__":
     args = get_args()
+    cfg = Config.fromfile(args.config)
 
     ckpt = args.ckpt
     if ckpt is None:
@@ -35,59 +36,47 @@ if __name__ == "__main__":
         base_dir = os.path.dirname(ckpt)
     masks_output_dir = os.path.join(base_dir, "mask_rgb") 
 
-    cfg = Config.fromfile(args.config)
-    model = myTrain.load_from_checkpoint(ckpt, cfg = cfg)
-    model = model.to('cuda')
+    device = torch.device('cuda:{}'.format(cfg.gpus[0]))
+    # a one-off pass over the test set does not pay back a max-autotune compile,
+    # and torch 2.0 compiled graphs reject the inference tensors used below
+    cfg.compile = False
+    model = myTrain.load_from_checkpoint(ckpt, cfg = cfg, map_location = device)
+    model = model.to(device)
 
     model.eval()
 
-    metric_cfg_1 = cfg.metric_cfg1
-    metric_cfg_2 = cfg.metric_cfg2
-    
-    test_oa=torchmetrics.Accuracy(**metric_cfg_1).to('cuda')
-    test_prec = torchmetrics.Precision(**metric_cfg_2).to('cuda')
-    test_recall = torchmetrics.Recall(**metric_cfg_2).to('cuda')
-    test_f1 = torchmetrics.F1Score(**metric_cfg_2).to('cuda')
-    test_iou=torchmetrics.JaccardIndex(**metric_cfg_2).to('cuda')
+    test_confmat = build_confmat(cfg).to(device)
 
     results = []
-    with torch.no_grad():
+    with torch.inference_mode():
         test_loader = build_dataloader(cfg.dataset_config, mode='test')
         for input in tqdm(test_loader):
 
-            raw_predictions, mask, img_id = model(input[0].cuda(), input[1].cuda()), input[2].cuda(), input[3]
-            pred = raw_predictions.argmax(dim=1)
+            imgA = input[0].to(device, non_blocking=True)
+            imgB = input[1].to(device, non_blocking=True)
+            mask, img_id = input[2].to(device, non_blocking=True), input[3]
+            pred = model(imgA, imgB).argmax(dim=1)
 
-            test_oa(pred, mask)
-            test_iou(pred, mask)
-            test_prec(pred, mask)
-            test_f1(pred, mask)
-            test_recall(pred, mask)
+            test_confmat.update(pred, mask)
 
-            for i in range(raw_predictions.shape[0]):
+            for i in range(pred.shape[0]):
                 mask_real = mask[i].cpu().numpy()
                 mask_pred = pred[i].cpu().numpy()
                 mask_name = str(img_id[i])
                 results.append((mask_real, mask_pred, masks_output_dir, mask_name))
 
-    metrics = [test_prec.compute(),
-               test_recall.compute(),
-               test_f1.compute(),
-               test_iou.compute()]
+    metrics, oa = confmat_metrics(test_confmat.compute().cpu())
     
-    total_metrics = [test_oa.compute().cpu().numpy(),
-                     np.mean([item.cpu() for item in metrics[0]]),
-                     np.mean([item.cpu() for item in metrics[1]]),
-                     np.mean([item.cpu() for item in metrics[2]]),
-                     np.mean([item.cpu() for item in metrics[3]])]
+    total_metrics = [oa.item()] + metrics.mean(dim=1).tolist()
 
     result_table = prettytable.PrettyTable()
     result_table.field_names = ['Class', 'OA', 'Precision', 'Recall', 'F1_Score', 'IOU']
 
-    for i in range(2):
+    cpu_metrics = metrics.numpy()
+    for i in range(cpu_metrics.shape[1]):
         item = [i, '--']
-        for j in range(len(metrics)):
-            item.append(np.round(metrics[j][i].cpu().numpy(), 4))
+        for j in range(cpu_metrics.shape[0]):
+            item.append(np.round(cpu_metrics[j][i], 4))
         result_table.add_row(item)
 
     total = [np.round(v, 4) for v in total_metrics]
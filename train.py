@@ -1,4 +1,5 @@
 import torch
+import torch._dynamo
 import torch.nn as nn
 from torch.utils.data import DataLoader
 from torch.optim.lr_scheduler import CosineAnnealingWarmRestarts
@@ -6,7 +7,6 @@ from pytorch_lightning import LightningModule, Trainer, seed_everything
 from pytorch_lightning.callbacks import LearningRateMonitor, ModelCheckpoint, TQDMProgressBar
 from pytorch_lightning.loggers import TensorBoardLogger
 import torchmetrics
-from tqdm import tqdm
 
 import prettytable
 import numpy as np
@@ -18,16 +18,45 @@ from rscd.losses import build_loss
 from utils.config import Config
 
 import os
-import sys
-sys.path.append('rscd')
-
-seed_everything(1234, workers=True)
 
 def get_args():
     parser = argparse.ArgumentParser('description=Change detection of remote sensing images')
     parser.add_argument("-c", "--config", type=str, default="configs/STNet.py")
     return parser.parse_args()
 
+def get_precision(cfg):
+    # bf16 keeps the fp32 exponent range, so no loss scaler is needed on Ampere+;
+    # older cards only emulate bf16 and get fp16 instead
+    if not torch.cuda.is_available():
+        return '32-true'
+    if torch.cuda.get_device_capability(cfg.gpus[0])[0] >= 8:
+        return 'bf16-mixed'
+    return '16-mixed'
+
+def supports_inference_mode(compiled):
+    # torch 2.0 compiled graphs reject inference tensors, fixed in 2.1
+    torch_version = tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2])
+    return not compiled or torch_version >= (2, 1)
+
+def build_confmat(cfg):
+    # validate_args would scan every batch for out-of-range labels on the host
+    return torchmetrics.ConfusionMatrix(task = cfg.metric_cfg2.task,
+                                        num_classes = cfg.metric_cfg2.num_classes,
+                                        validate_args = False)
+
+def confmat_metrics(confmat):
+    # rows of the result are per-class precision, recall, f1 and iou
+    confmat = confmat.float()
+    tp = confmat.diag()
+    fp = confmat.sum(dim=0) - tp
+    fn = confmat.sum(dim=1) - tp
+    metrics = torch.stack([tp / (tp + fp).clamp(min=1),
+                           tp / (tp + fn).clamp(min=1),
+                           2 * tp / (2 * tp + fp + fn).clamp(min=1),
+                           tp / (tp + fp + fn).clamp(min=1)])
+    oa = tp.sum() / confmat.sum().clamp(min=1)
+    return metrics, oa
+
 class myTrain(LightningModule):
     def __init__(self, cfg, log_dir = None):
         super(myTrain, self).__init__()
@@ -35,37 +64,34 @@ class myTrain(LightningModule):
         self.cfg = cfg
         self.log_dir = log_dir
         self.net = build_model(cfg.model_config)
+        # NHWC lets cuDNN feed Tensor Cores without transposing around every conv
+        self.channels_last = cfg.get('channels_last', True)
+        if self.channels_last:
+            self.net = self.net.to(memory_format=torch.channels_last)
+        # compile the bound forward rather than wrapping self.net, so parameter
+        # names (used by the layerwise lr groups) and checkpoint keys are unchanged
+        self._net_forward = None
+        if cfg.get('compile', True):
+            self._net_forward = torch.compile(self.net.forward, mode='max-autotune', dynamic=False)
+        self.compiled = self._net_forward is not None
         self.loss = build_loss(cfg.loss_config)
-
-        self.loss.to("cuda")
         
-        metric_cfg1 = cfg.metric_cfg1
-        metric_cfg2 = cfg.metric_cfg2
-        
-        self.tr_oa=torchmetrics.Accuracy(**metric_cfg1)
-        self.tr_prec = torchmetrics.Precision(**metric_cfg2)
-        self.tr_recall = torchmetrics.Recall(**metric_cfg2)
-        self.tr_f1 = torchmetrics.F1Score(**metric_cfg2)
-        self.tr_iou=torchmetrics.JaccardIndex(**metric_cfg2)
-
-        self.val_oa=torchmetrics.Accuracy(**metric_cfg1)
-        self.val_prec = torchmetrics.Precision(**metric_cfg2)
-        self.val_recall = torchmetrics.Recall(**metric_cfg2)
-        self.val_f1 = torchmetrics.F1Score(**metric_cfg2)
-        self.val_iou=torchmetrics.JaccardIndex(**metric_cfg2)
-
-        self.test_oa=torchmetrics.Accuracy(**metric_cfg1)
-        self.test_prec = torchmetrics.Precision(**metric_cfg2)
-        self.test_recall = torchmetrics.Recall(**metric_cfg2)
-        self.test_f1 = torchmetrics.F1Score(**metric_cfg2)
-        self.test_iou=torchmetrics.JaccardIndex(**metric_cfg2)
+        # one confusion matrix per phase, all reported metrics are derived from it
+        self.tr_confmat = build_confmat(cfg)
+        self.val_confmat = build_confmat(cfg)
+        self.test_confmat = build_confmat(cfg)
 
         self.test_max_f1 = -1
-
-        self.test_loader = build_dataloader(cfg.dataset_config, mode='test')
+        self.log_files = dict()
 
     def forward(self, x1, x2) :
-        pred = self.net(x1, x2)
+        if self.channels_last:
+            x1 = x1.contiguous(memory_format=torch.channels_last)
+            x2 = x2.contiguous(memory_format=torch.channels_last)
+        if self._net_forward is None:
+            pred = self.net(x1, x2)
+        else:
+            pred = self._net_forward(x1, x2)
         return pred
 
     def configure_optimizers(self):
@@ -77,17 +103,28 @@ class myTrain(LightningModule):
         return loader
 
     def val_dataloader(self):
+        # the test split runs as a second validation loader so that
+        # test_change_f1 is still logged every epoch for ckpt_cb2
         loader = build_dataloader(self.cfg.dataset_config, mode='val')
+        return [loader, self.test_dataloader()]
+
+    def test_dataloader(self):
+        loader = build_dataloader(self.cfg.dataset_config, mode='test')
         return loader
 
     def output(self, metrics, total_metrics, mode):
+        # metrics are already synced across ranks, only rank 0 reports them
+        if not self.trainer.is_global_zero:
+            return
+
         result_table = prettytable.PrettyTable()
         result_table.field_names = ['Class', 'OA', 'Precision', 'Recall', 'F1_Score', 'IOU']
 
-        for i in range(len(metrics[0])):
+        cpu_metrics = metrics.numpy()
+        for i in range(cpu_metrics.shape[1]):
             item = [i, '--']
-            for j in range(len(metrics)):
-                item.append(np.round(metrics[j][i].cpu().numpy(), 4))
+            for j in range(cpu_metrics.shape[0]):
+                item.append(np.round(cpu_metrics[j][i], 4))
             result_table.add_row(item)
 
         total = list(total_metrics.values())
@@ -102,20 +139,31 @@ class myTrain(LightningModule):
         if self.log_dir:
             base_dir = self.log_dir
         else:
-            base_dir = os.path.join('work_dirs', cfg.exp_name)
+            base_dir = os.path.join('work_dirs', self.cfg.exp_name)
 
         if mode == 'test':
             file_name = os.path.join(base_dir, "test_metrics_rest.txt") 
-            if metrics[2][1] > self.test_max_f1:
-                self.test_max_f1 = metrics[2][1]
+            if cpu_metrics[2][1] > self.test_max_f1 and not self.trainer.sanity_checking:
+                self.test_max_f1 = cpu_metrics[2][1]
                 file_name = os.path.join(base_dir, "test_metrics_max.txt") 
         else:
             file_name = os.path.join(base_dir, "train_metrics.txt") 
             
-        f = open(file_name,"a")
+        f = self.log_file(file_name)
         f.write('epoch:{}/{} {}\n'.format(self.current_epoch, self.cfg.epoch, mode))
         f.write(str(result_table)+'\n')
-        f.close()
+
+    def log_file(self, file_name):
+        # keep metric files open for the whole run instead of reopening them every epoch
+        if file_name not in self.log_files:
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            self.log_files[file_name] = open(file_name, "a", buffering=1 << 16)
+        return self.log_files[file_name]
+
+    def teardown(self, stage):
+        for f in self.log_files.values():
+            f.close()
+        self.log_files.clear()
 
     def training_step(self, batch, batch_idx):
         imgA, imgB, mask = batch[0], batch[1], batch[2]
@@ -123,119 +171,105 @@ class myTrain(LightningModule):
 
         loss = self.loss(preds, mask)
                     
-        pred = preds.argmax(dim=1)
+        pred = preds.detach().argmax(dim=1)
 
-        self.tr_oa(pred, mask)
-        self.tr_prec(pred, mask)
-        self.tr_recall(pred, mask)
-        self.tr_f1(pred, mask)
-        self.tr_iou(pred, mask)
+        self.tr_confmat.update(pred, mask.detach())
 
         self.log('tr_loss', loss, on_step=True,on_epoch=True,prog_bar=True)
         return loss
 
+    def _epoch_metrics(self, confmat, prefix):
+        # one device-to-host copy, the metrics are derived on the host
+        metrics, oa = confmat_metrics(confmat.compute().cpu())
+        means = metrics.mean(dim=1).tolist()
+
+        log = {prefix + '_oa': oa.item(),
+               prefix + '_prec': means[0],
+               prefix + '_recall': means[1],
+               prefix + '_f1': means[2],
+               prefix + '_miou': means[3]}
+        return metrics, log
+
+    def on_train_epoch_start(self):
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+
     def on_train_epoch_end(self):
-        metrics = [self.tr_prec.compute(),
-                   self.tr_recall.compute(),
-                   self.tr_f1.compute(),
-                   self.tr_iou.compute()]
-        
-        log = {'tr_oa': float(self.tr_oa.compute().cpu()),
-               'tr_prec': np.mean([item.cpu() for item in metrics[0]]),
-               'tr_recall': np.mean([item.cpu() for item in metrics[1]]),
-               'tr_f1': np.mean([item.cpu() for item in metrics[2]]),
-               'tr_miou': np.mean([item.cpu() for item in metrics[3]])}
+        metrics, log = self._epoch_metrics(self.tr_confmat, 'tr')
         
         self.output(metrics, log, 'train')
         
         for key, value in zip(log.keys(), log.values()):
             self.log(key, value, on_step=False,on_epoch=True,prog_bar=True)
-        self.log('tr_change_f1', metrics[2][1], on_step=False,on_epoch=True,prog_bar=True)
+        self.log('tr_change_f1', metrics[2][1].item(), on_step=False,on_epoch=True,prog_bar=True)
+        if self.device.type == 'cuda':
+            # allocator peak over the epoch's training and validation
+            self.log('peak_vram_mb', torch.cuda.max_memory_allocated(self.device) / 2**20, on_step=False,on_epoch=True)
+
+        self.tr_confmat.reset()
+
+        # the tables are small, push them out once per epoch so the files stay current
+        for f in self.log_files.values():
+            f.flush()
+
+    def on_validation_epoch_start(self):
+        self.val_confmat.reset()
+        self.test_confmat.reset()
 
-        self.tr_oa.reset()
-        self.tr_prec.reset()
-        self.tr_recall.reset()
-        self.tr_f1.reset()
-        self.tr_iou.reset()
+    def validation_step(self, batch, batch_idx, dataloader_idx=0):
+        if dataloader_idx == 1:
+            return self.test_step(batch, batch_idx)
 
-    def validation_step(self, batch, batch_idx):
         imgA, imgB, mask = batch[0], batch[1], batch[2]
-        preds = self(imgA, imgB)
+        # the loss is only logged here, nothing may hold on to the graph
+        preds = self(imgA, imgB).detach()
         
         loss = self.loss(preds, mask)
         pred = preds.argmax(dim=1)
 
-        self.val_oa(pred, mask)
-        self.val_prec(pred, mask)
-        self.val_recall(pred, mask)
-        self.val_f1(pred, mask)
-        self.val_iou(pred, mask)
+        self.val_confmat.update(pred, mask)
 
-        self.log('val_loss', loss, on_step=True,on_epoch=True,prog_bar=True)
+        self.log('val_loss', loss, on_step=True,on_epoch=True,prog_bar=True,add_dataloader_idx=False)
         return loss
 
     def on_validation_epoch_end(self):
-        metrics = [self.val_prec.compute(),
-                   self.val_recall.compute(),
-                   self.val_f1.compute(),
-                   self.val_iou.compute()]
-
-        log = {'val_oa': float(self.val_oa.compute().cpu()),
-               'val_prec': np.mean([item.cpu() for item in metrics[0]]),
-               'val_recall': np.mean([item.cpu() for item in metrics[1]]),
-               'val_f1': np.mean([item.cpu() for item in metrics[2]]),
-               'val_miou': np.mean([item.cpu() for item in metrics[3]])}
+        metrics, log = self._epoch_metrics(self.val_confmat, 'val')
         
         self.output(metrics, log, 'val')
 
         for key, value in zip(log.keys(), log.values()):
             self.log(key, value, on_step=False,on_epoch=True,prog_bar=True)
-        self.log('val_change_f1', metrics[2][1], on_step=False,on_epoch=True,prog_bar=True)
+        self.log('val_change_f1', metrics[2][1].item(), on_step=False,on_epoch=True,prog_bar=True)
 
-        self.val_oa.reset()
-        self.val_prec.reset()
-        self.val_recall.reset()
-        self.val_f1.reset()
-        self.val_iou.reset()
+        self.val_confmat.reset()
 
-        res1 = self.test()
+        self.on_test_epoch_end()
 
-        self.log('test_change_f1', res1, on_step=False,on_epoch=True,prog_bar=True)
+    def on_test_epoch_start(self):
+        self.test_confmat.reset()
 
-    def test(self):
-        for input in tqdm(self.test_loader):
-            raw_predictions, mask_test = self(input[0].cuda(cfg.gpus[0]), input[1].cuda(cfg.gpus[0])), input[2].cuda(cfg.gpus[0])
+    def test_step(self, batch, batch_idx):
+        imgA, imgB, mask_test = batch[0], batch[1], batch[2]
+        raw_predictions = self(imgA, imgB).detach()
 
-            pred_test = raw_predictions.argmax(dim=1)
+        pred_test = raw_predictions.argmax(dim=1)
 
-            self.test_oa(pred_test, mask_test)
-            self.test_iou(pred_test, mask_test)
-            self.test_prec(pred_test, mask_test)
-            self.test_f1(pred_test, mask_test)
-            self.test_recall(pred_test, mask_test)
+        self.test_confmat.update(pred_test, mask_test)
 
-        metrics_test = [self.test_prec.compute(),
-                   self.test_recall.compute(),
-                   self.test_f1.compute(),
-                   self.test_iou.compute()]
-        
-        log = {'test_oa': float(self.test_oa.compute().cpu()),
-            'test_prec': np.mean([item.cpu() for item in metrics_test[0]]),
-            'test_recall': np.mean([item.cpu() for item in metrics_test[1]]),
-            'test_f1': np.mean([item.cpu() for item in metrics_test[2]]),
-            'test_miou': np.mean([item.cpu() for item in metrics_test[3]])}
+    def on_test_epoch_end(self):
+        metrics_test, log = self._epoch_metrics(self.test_confmat, 'test')
         
         self.output(metrics_test, log, 'test')
-        
-        self.test_oa.reset()
-        self.test_prec.reset()
-        self.test_recall.reset()
-        self.test_f1.reset()
-        self.test_iou.reset()
 
-        return metrics_test[2][1]
+        self.log('test_change_f1', metrics_test[2][1].item(), on_step=False,on_epoch=True,prog_bar=True)
+        
+        self.test_confmat.reset()
 
 if __name__ == "__main__":  
+    seed_everything(1234, workers=True)
+    torch.set_float32_matmul_precision('high')
+    torch._dynamo.config.cache_size_limit = 64
+
     args = get_args()
     cfg = Config.fromfile(args.config)
     logger = TensorBoardLogger(save_dir = "work_dirs",
@@ -268,13 +302,22 @@ if __name__ == "__main__":
     callbacks = [ckpt_cb1, ckpt_cb2, pbar, lr_monitor]
     
     trainer = Trainer(max_epochs = cfg.epoch,
-                    #   precision='16-mixed',
+                      precision = cfg.get('precision') or get_precision(cfg),
                       callbacks = callbacks,
                       logger = logger,
                       enable_model_summary = True,
                       accelerator = 'auto',
                       devices = cfg.gpus,
+                      check_val_every_n_epoch = cfg.check_val_every_n_epoch,
+                      # tr_loss stays the per-micro-batch mean; Lightning scales the
+                      # backward pass by 1/N, steps the optimizer every N batches and
+                      # runs the first N-1 backwards under DDP no_sync
+                      accumulate_grad_batches = cfg.get('accumulate_grad_batches', 1),
+                      strategy = 'ddp' if len(cfg.gpus) > 1 else 'auto',
                       num_sanity_val_steps = 2,
+                      # Lightning only falls back to no_grad for a compiled LightningModule,
+                      # not for the compiled inner forward used here
+                      inference_mode = supports_inference_mode(model.compiled),
                       benchmark = True)
     
     trainer.fit(model, ckpt_path=cfg.resume_ckpt_path)
\ No newline at end of file